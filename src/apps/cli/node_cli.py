@@ -2,10 +2,15 @@
 Command line interface for interacting with a P2P node.
 """
 import cmd
+import sys
 import threading
-import time
 from typing import Optional
 
+try:
+    import readline
+except ImportError:  # readline is not available on Windows
+    readline = None
+
 from src.lib.p2p.p2p_node import P2PNode
 
 
@@ -57,8 +62,9 @@ class NodeCLI(cmd.Cmd):
             _: Command arguments (unused).
         """
         print("Stopping node...")
-        self.node.stop()
+        # Deactivate first, so the receiving thread exits once stopping wakes it up
         self.active = False
+        self.node.stop()
 
     def do_connect(self, arg: str) -> None:
         """
@@ -100,11 +106,22 @@ class NodeCLI(cmd.Cmd):
 
     def receive_messages(self) -> None:
         """
-        Continuously check for and print any received messages while the node is active.
+        Wait for and print received messages while the node is active.
         """
         while self.active:
             message: Optional[str] = self.node.read_next_message()
-            if message:
-                print(f"\nReceived message: {message}")
-                print(self.prompt, end="")  # reprint prompt
-            time.sleep(0.1)
+            if message is None:
+                continue
+            self.print_message(message)
+
+    def print_message(self, message: str) -> None:
+        """
+        Print a received message above the prompt, keeping any partially typed input.
+
+        Args:
+            message: The received message.
+        """
+        line_buffer = readline.get_line_buffer() if readline is not None else ""
+        # Clear the prompt line, print the message and redraw the prompt with the typed input
+        sys.stdout.write(f"\r\x1b[KReceived message: {message}\n{self.prompt}{line_buffer}")
+        sys.stdout.flush()
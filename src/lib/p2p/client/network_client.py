@@ -1,29 +1,89 @@
+import os
 import socket
-from typing import Optional
+from typing import List, Optional
+
+from src.lib.p2p.utils.socket_options import configure_socket
+
+
+def _iov_max() -> int:
+    """Returns the maximum number of buffers a single sendmsg call accepts, 1024 if unknown."""
+    try:
+        iov_max = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):  # no sysconf, e.g. on Windows
+        return 1024
+    return iov_max if iov_max > 0 else 1024
+
+
+# The maximum number of buffers passed to a single sendmsg call, e.g. 1024 on Linux
+IOV_MAX = _iov_max()
 
 
 class NetworkClient:
     """
     NetworkClient is the low-level network client that handles networking.
-    It opens a connection to a server, sends a message, and closes the connection.
+    It holds a single connection to a server, which is opened once and kept open, so that
+    consecutive messages are written over the same socket until it is closed.
 
     Args:
-        None
+        rcvbuf (Optional[int]): The receive buffer size, or None to let the kernel autotune it.
+        sndbuf (Optional[int]): The send buffer size, or None to let the kernel autotune it.
     """
 
-    def __init__(self):
+    def __init__(self, rcvbuf: Optional[int] = None, sndbuf: Optional[int] = None):
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
         self.client_socket: Optional[socket.socket] = None
 
-    def connect(self, host: str, port: int) -> None:
+    def connect(self, host: str, port: int, timeout: float = 1.0) -> None:
         """
         Connects the client to a given host and port.
 
         Args:
             host (str): The hostname or IP address of the server to connect to.
             port (int): The port number of the server to connect to.
+            timeout (float): The number of seconds to wait for the connection to be established.
+
+        Raises:
+            ConnectionRefusedError: If the server cannot be reached within the timeout.
         """
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((host, port))
+        configure_socket(self.client_socket, self.rcvbuf, self.sndbuf)
+        # Fail fast on unreachable peers instead of waiting for the kernel's connect timeout
+        self.client_socket.settimeout(timeout)
+        try:
+            self.client_socket.connect((host, port))
+        except OSError as e:
+            self.close()
+            raise ConnectionRefusedError(f"Could not connect to {host}:{port}") from e
+        self.client_socket.settimeout(None)
+
+    def is_connected(self) -> bool:
+        """
+        Checks without blocking whether the connection is still open.
+
+        Servers never write to this connection, so it only becomes readable once the server
+        closed or reset it, e.g. because it restarted. The check peeks at the socket instead
+        of selecting on it, so it works for file descriptors of any number.
+
+        Returns:
+            bool: False if there is no connection or the server closed it, True otherwise.
+        """
+        if self.client_socket is None:
+            return False
+        try:
+            if hasattr(socket, "MSG_DONTWAIT"):
+                data = self.client_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+            else:  # e.g. on Windows
+                self.client_socket.setblocking(False)
+                try:
+                    data = self.client_socket.recv(1, socket.MSG_PEEK)
+                finally:
+                    self.client_socket.setblocking(True)
+        except BlockingIOError:  # nothing to read, the connection is open
+            return True
+        except OSError:
+            return False
+        return bool(data)
 
     def send(self, message: bytes) -> None:
         """
@@ -34,6 +94,31 @@ class NetworkClient:
         """
         self.client_socket.sendall(message)
 
+    def send_parts(self, parts: List[bytes]) -> None:
+        """
+        Sends several buffers to the server as one contiguous message.
+
+        Uses a scatter-gather sendmsg call where available, so the buffers are not
+        concatenated in Python first. Falls back to sendall on platforms without sendmsg.
+
+        Args:
+            parts (List[bytes]): The buffers to send, in order.
+        """
+        if not hasattr(self.client_socket, "sendmsg"):
+            self.client_socket.sendall(b"".join(parts))
+            return
+
+        buffers = [memoryview(part) for part in parts]
+        while buffers:
+            sent = self.client_socket.sendmsg(buffers[:IOV_MAX])
+            sent_buffers = 0
+            while sent_buffers < len(buffers) and sent >= buffers[sent_buffers].nbytes:
+                sent -= buffers[sent_buffers].nbytes
+                sent_buffers += 1
+            del buffers[:sent_buffers]
+            if sent:
+                buffers[0] = buffers[0][sent:]
+
     def close(self) -> None:
         """
         Closes the client socket.
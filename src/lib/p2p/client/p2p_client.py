@@ -2,15 +2,40 @@
 A peer-to-peer client used to connect to other nodes in the network.
 
 This client uses a low-level network client to handle networking, and adds message handling on top.
+Connections to other nodes are opened lazily and kept alive, so consecutive messages to the same
+node reuse the same socket. Messages queued for a node while a send is pending are written
+together in a single call.
 """
 
-from threading import Thread
-from typing import Any, Dict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Dict, List, Optional
 
 from src.lib.p2p.client.network_client import NetworkClient
+from src.lib.p2p.peer import Peer
 from src.lib.p2p.utils.message_protocol import MessageProtocol
 
 
+class PeerConnection:
+    """
+    An outgoing connection to a peer, together with the messages waiting to be sent over it.
+
+    Attributes:
+        network_client: The low-level client holding the socket.
+        send_lock: A lock serializing connects and writes on the socket.
+        pending_lock: A lock guarding the pending buffer and the flush flag.
+        pending: The frame headers and encoded messages that have not been written yet.
+        flush_scheduled: Whether a flush of the pending buffer is already scheduled.
+    """
+
+    def __init__(self, network_client: NetworkClient):
+        self.network_client: NetworkClient = network_client
+        self.send_lock: Lock = Lock()
+        self.pending_lock: Lock = Lock()
+        self.pending: List[bytes] = []
+        self.flush_scheduled: bool = False
+
+
 class P2PClient:
     """
     The high-level P2P client.
@@ -18,25 +43,49 @@ class P2PClient:
     Attributes:
         node: The node this client belongs to.
         message_protocol: The protocol for encoding and decoding messages.
+        connections: The connections to other nodes, one per peer.
+        executor: The pool of worker threads that send messages in the background.
+        rcvbuf: The receive buffer size of outgoing connections, or None to let the kernel autotune it.
+        sndbuf: The send buffer size of outgoing connections, or None to let the kernel autotune it.
     """
 
-    def __init__(self, node: Any):
+    max_workers: int = 32
+
+    def __init__(
+        self, node: Any, rcvbuf: Optional[int] = None, sndbuf: Optional[int] = None
+    ):
         """
         Initialize a new P2PClient instance.
 
         Args:
             node: The node this client belongs to.
+            rcvbuf: The receive buffer size of outgoing connections, or None to let the kernel autotune it.
+            sndbuf: The send buffer size of outgoing connections, or None to let the kernel autotune it.
         """
         self.node = node
+        self.rcvbuf: Optional[int] = rcvbuf
+        self.sndbuf: Optional[int] = sndbuf
         self.message_protocol: MessageProtocol = MessageProtocol()
+        self.connections: Dict[Peer, PeerConnection] = {}
+        self.connections_lock: Lock = Lock()
+        self.executor: ThreadPoolExecutor = self.create_executor()
 
     def start(self) -> None:
         """Start the client."""
         pass
 
     def stop(self) -> None:
-        """Stop the client."""
-        pass
+        """Stop the client and close all open connections."""
+        # Worker threads are only spawned on demand, so the replacement executor
+        # costs nothing until the client is used again.
+        executor, self.executor = self.executor, self.create_executor()
+        executor.shutdown(wait=False)
+        with self.connections_lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        for connection in connections:
+            with connection.send_lock:
+                connection.network_client.close()
 
     def send_message(self, host: str, port: int, message_type: str, data: Any) -> None:
         """
@@ -48,29 +97,128 @@ class P2PClient:
             message_type: The type of the message to send.
             data: The data of the message to send.
         """
-        message: Dict[str, Any] = {
-            "type": message_type,
-            "data": data,
-        }
-        encoded_message: bytes = self.message_protocol.encode_message(message)
-        Thread(target=self.connect_and_send, args=(host, port, encoded_message)).start()
-
-    def connect_and_send(self, host: str, port: int, encoded_message: bytes) -> None:
+        encoded_message: bytes = self.message_protocol.encode(message_type, data)
+        self.queue_message(Peer(host, port), encoded_message)
+
+    def create_executor(self) -> ThreadPoolExecutor:
+        """Create the pool of worker threads used to send messages."""
+        return ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="p2p-send"
+        )
+
+    def queue_message(
+        self, peer: Peer, encoded_message: bytes, header: Optional[bytes] = None
+    ) -> None:
         """
-        Connect to another node and send it a message.
+        Append an encoded message to the pending buffer of a peer and schedule a flush.
+
+        Messages queued before the scheduled flush runs are sent together with it. The
+        message is not copied, so the same bytes can be queued for many peers.
 
         Args:
-            host: The host address of the node to connect to.
-            port: The port number of the node to connect to.
+            peer: The peer to send the message to.
             encoded_message: The encoded message to send.
+            header: The frame header of the encoded message, computed if not given.
+        """
+        connection = self.get_connection(peer)
+        if header is None:
+            header = self.message_protocol.frame_header(encoded_message)
+        with connection.pending_lock:
+            connection.pending.append(header)
+            connection.pending.append(encoded_message)
+            if connection.flush_scheduled:
+                return
+            connection.flush_scheduled = True
+        # The flush is bound to this connection, so it drains this buffer even if the
+        # connection is dropped and replaced before the flush runs
+        self.executor.submit(self.flush, peer, connection)
+
+    def flush(self, peer: Peer, connection: Optional[PeerConnection] = None) -> None:
+        """
+        Write all pending messages of a peer, connecting to it first if there is no open connection.
+
+        If the node cannot be reached, even on a fresh connection, the pending messages and
+        the connection are dropped and the node is removed from the peers.
+
+        Args:
+            peer: The peer whose pending messages should be sent.
+            connection: The connection whose pending messages should be sent, by default the
+                current connection to the peer.
         """
-        network_client: NetworkClient = NetworkClient()
-        try:
-            network_client.connect(host, port)
-        except ConnectionRefusedError:
-            self.node.remove_peer(host, port)
-            return
-        try:
-            network_client.send(encoded_message)
-        finally:
+        if connection is None:
+            connection = self.get_connection(peer)
+        with connection.send_lock:
+            with connection.pending_lock:
+                parts, connection.pending = connection.pending, []
+                connection.flush_scheduled = False
+            if not parts:
+                return
+            network_client = connection.network_client
+            try:
+                self.write(network_client, peer, parts)
+            except OSError:  # refused, reset, broken pipe or timed out by keepalive probes
+                network_client.close()
+                self.drop_connection(peer, connection)
+                self.node.remove_peer(peer.host, peer.port)
+                return
+            if self.connections.get(peer) is not connection:
+                # The connection was dropped while messages were still queued on it, they
+                # are sent now, but later messages go through the peer's new connection
+                network_client.close()
+
+    def write(self, network_client: NetworkClient, peer: Peer, parts: List[bytes]) -> None:
+        """
+        Write buffers to a peer, reconnecting once if the open connection turns out to be broken.
+
+        Args:
+            network_client: The low-level client of the connection to the peer.
+            peer: The peer to write to.
+            parts: The frame headers and encoded messages to write.
+
+        Raises:
+            OSError: If the buffers cannot be written on a fresh connection either.
+        """
+        if network_client.client_socket is not None:
+            if network_client.is_connected():
+                try:
+                    network_client.send_parts(parts)
+                    return
+                except OSError:
+                    pass
+            # The peer closed the connection since the last flush, e.g. because it restarted.
+            # What was written to the old connection is lost with it, so send everything again.
             network_client.close()
+        network_client.connect(peer.host, peer.port)
+        network_client.send_parts(parts)
+
+    def get_connection(self, peer: Peer) -> PeerConnection:
+        """
+        Get the connection to a peer, creating an unconnected one if none exists yet.
+
+        Args:
+            peer: The peer to get the connection for.
+
+        Returns:
+            The connection to the peer.
+        """
+        connection = self.connections.get(peer)
+        if connection is None:
+            with self.connections_lock:
+                connection = self.connections.get(peer)
+                if connection is None:
+                    connection = PeerConnection(NetworkClient(self.rcvbuf, self.sndbuf))
+                    self.connections[peer] = connection
+        return connection
+
+    def drop_connection(self, peer: Peer, connection: Optional[PeerConnection] = None) -> None:
+        """
+        Forget the connection to a peer, so the next message opens a new one.
+
+        Args:
+            peer: The peer whose connection should be dropped.
+            connection: The connection to drop. If given, a newer connection to the peer is
+                kept. By default the current connection is dropped.
+        """
+        with self.connections_lock:
+            if connection is None or self.connections.get(peer) is connection:
+                self.connections.pop(peer, None)
@@ -5,26 +5,14 @@ A P2P node is a member of a peer-to-peer network, and can act as both a client a
 """
 
 import logging
-from typing import List, Tuple, Optional, Set
-from dataclasses import dataclass
+import threading
+from typing import Dict, List, Tuple, Optional, Set
 
 from src.lib.p2p.client.p2p_client import P2PClient
+from src.lib.p2p.peer import Peer
 from src.lib.p2p.server.p2p_server import P2PServer
 
 
-@dataclass(frozen=True)
-class Peer:
-    """
-    A class representing a peer in a peer-to-peer network.
-
-    Attributes:
-        host: The host address of the peer.
-        port: The port number of the peer.
-    """
-    host: str
-    port: int
-
-
 class P2PNode:
     """
     A node in a peer-to-peer network.
@@ -35,14 +23,49 @@ class P2PNode:
         server: The server instance for this node.
         client: The client instance for this node.
         peers: The set of peers this node is connected to.
+        peers_by_address: The peers this node is connected to, by host address and port number.
+        peers_lock: A lock guarding changes to the peers.
+        peers_snapshot: The cached peers as a tuple, or None if the peers changed since.
+        serializable_peers: The cached serialized peer list, or None if the peers changed since.
+        encoded_peers: The cached encoded update_peers message, or None if the peers changed since.
+        peers_broadcast_timer: The pending broadcast of the peer list, if one is scheduled.
     """
-    def __init__(self, host: str, port: int):
+
+    # Changes to the peer set within this many seconds are announced in a single broadcast
+    peers_broadcast_delay: float = 0.25
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        rcvbuf: Optional[int] = None,
+        sndbuf: Optional[int] = None,
+    ):
+        """
+        Initialize a new P2PNode instance.
+
+        The socket buffer sizes are left to the kernel unless given, since fixing them
+        disables the kernel's autotuning of the TCP window.
+
+        Args:
+            host: The host address of this node.
+            port: The port number of this node.
+            rcvbuf: The receive buffer size of all connections, or None to let the kernel autotune it.
+            sndbuf: The send buffer size of all connections, or None to let the kernel autotune it.
+        """
         self.logger: logging.Logger = logging.getLogger(__name__)
         self.host: str = host
         self.port: int = port
-        self.server: P2PServer = P2PServer(self, host, port)  # own server
-        self.client: P2PClient = P2PClient(self)  # for client connections to other servers
+        self.server: P2PServer = P2PServer(self, host, port, rcvbuf, sndbuf)  # own server
+        self.client: P2PClient = P2PClient(self, rcvbuf, sndbuf)  # for client connections to other servers
         self.peers: Set[Peer] = set()
+        self.peers_by_address: Dict[Tuple[str, int], Peer] = {}
+        self.peers_lock: threading.RLock = threading.RLock()
+        self.peers_snapshot: Optional[Tuple[Peer, ...]] = None
+        self.serializable_peers: Optional[Tuple[Tuple[str, int], ...]] = None
+        self.encoded_peers: Optional[bytes] = None
+        self.peers_broadcast_timer: Optional[threading.Timer] = None
+        self.peers_broadcast_lock: threading.Lock = threading.Lock()
 
     def start(self) -> None:
         """Start the node."""
@@ -51,31 +74,75 @@ class P2PNode:
 
     def stop(self) -> None:
         """Stop the node."""
+        with self.peers_broadcast_lock:
+            if self.peers_broadcast_timer is not None:
+                self.peers_broadcast_timer.cancel()
+                self.peers_broadcast_timer = None
         self.server.stop()
         self.client.stop()
 
-    def get_serializable_peers(self) -> List[Tuple[str, int]]:
-        """Get a list of the peers, serialized as tuples of host address and port number."""
-        return [(peer.host, peer.port) for peer in self.peers] + [(self.host, self.port)]
+    def get_serializable_peers(self) -> Tuple[Tuple[str, int], ...]:
+        """
+        Get the peers, including this node, serialized as tuples of host address and port number.
+
+        The result is cached until the set of peers changes.
+        """
+        serializable_peers = self.serializable_peers
+        if serializable_peers is None:
+            with self.peers_lock:
+                serializable_peers = tuple(self.peers_by_address) + (
+                    (self.host, self.port),
+                )
+                self.serializable_peers = serializable_peers
+        return serializable_peers
+
+    def get_encoded_peers(self) -> bytes:
+        """
+        Get the update_peers message announcing the serialized peers, encoded for sending.
+
+        The result is cached until the set of peers changes, so answering repeated requests
+        for the peer list does not encode it again.
+        """
+        encoded_peers = self.encoded_peers
+        if encoded_peers is None:
+            with self.peers_lock:
+                encoded_peers = self.client.message_protocol.encode(
+                    "update_peers", self.get_serializable_peers()
+                )
+                self.encoded_peers = encoded_peers
+        return encoded_peers
+
+    def get_peers_snapshot(self) -> Tuple[Peer, ...]:
+        """
+        Get the peers as a tuple that is safe to iterate while the peers change.
+
+        The result is cached until the set of peers changes.
+        """
+        peers_snapshot = self.peers_snapshot
+        if peers_snapshot is None:
+            with self.peers_lock:
+                peers_snapshot = tuple(self.peers)
+                self.peers_snapshot = peers_snapshot
+        return peers_snapshot
 
     def add_peer(self, peer: Peer) -> None:
         """
-        Add a peer to the set of peers.
+        Add a peer to the set of peers and schedule a broadcast of the peer list.
 
         If the peer is already in the set, does nothing.
         """
-        if peer in self.peers:
-            print(f"Peer {peer} already added!")
-            return
+        with self.peers_lock:
+            if peer in self.peers:
+                self.logger.debug("Peer %s already added!", peer)
+                return
 
-        self.peers.add(peer)
-        self.broadcast_message(
-            self.get_serializable_peers(), message_type="update_peers"
-        )
+            self.peers.add(peer)
+            self.peers_by_address[(peer.host, peer.port)] = peer
+            self.peers_changed()
 
     def remove_peer(self, host: str, port: int) -> None:
         """
-        Remove a peer from the set of peers.
+        Remove a peer from the set of peers and schedule a broadcast of the peer list.
 
         If the peer is not in the set, does nothing.
 
@@ -83,15 +150,42 @@ class P2PNode:
             host: The host address of the peer.
             port: The port number of the peer.
         """
-        peer = Peer(host, port)
-        if peer not in self.peers:
-            print(f"Peer {peer} already removed!")
-            return
+        with self.peers_lock:
+            peer = self.peers_by_address.pop((host, port), None)
+            if peer is None:
+                self.logger.debug("Peer %s:%s already removed!", host, port)
+                return
+
+            self.peers.discard(peer)
+            self.peers_changed()
+
+    def peers_changed(self) -> None:
+        """Invalidate the cached views of the peers and schedule a broadcast of the peer list."""
+        self.peers_snapshot = None
+        self.serializable_peers = None
+        self.encoded_peers = None
+        self.schedule_peers_broadcast()
+
+    def schedule_peers_broadcast(self) -> None:
+        """
+        Schedule a broadcast of the peer list to all peers.
 
-        self.peers.remove(peer)
-        self.broadcast_message(
-            self.get_serializable_peers(), message_type="update_peers"
-        )
+        If a broadcast is already scheduled, does nothing, so a burst of changes to the
+        peer set is announced once.
+        """
+        with self.peers_broadcast_lock:
+            if self.peers_broadcast_timer is not None:
+                return
+            timer = threading.Timer(self.peers_broadcast_delay, self.broadcast_peers)
+            timer.daemon = True
+            self.peers_broadcast_timer = timer
+        timer.start()
+
+    def broadcast_peers(self) -> None:
+        """Broadcast the current peer list to all peers."""
+        with self.peers_broadcast_lock:
+            self.peers_broadcast_timer = None
+        self.broadcast_encoded(self.get_encoded_peers())
 
     def connect_to_peer(self, host: str, port: int) -> bool:
         """
@@ -106,21 +200,17 @@ class P2PNode:
         Returns:
             True if the connection was successful, False otherwise.
         """
-        peer = Peer(host, port)
-
-        if peer in self.peers:
-            print(f"Peer {peer} already added!")
+        if (host, port) in self.peers_by_address:
+            self.logger.debug("Peer %s:%s already added!", host, port)
             return False
+        peer = Peer(host, port)
 
         def _exchange_peers_info():
             self.client.send_message(peer.host, peer.port, "request_peers",
                                      None)
-            self.client.send_message(
-                peer.host, peer.port, "update_peers",
-                self.get_serializable_peers()
-            )
+            self.client.queue_message(peer, self.get_encoded_peers())
 
-        print(f"Connected to new peer {host}:{port}")
+        self.logger.debug("Connected to new peer %s:%s", host, port)
         self.add_peer(peer)
         _exchange_peers_info()
         return True
@@ -129,27 +219,34 @@ class P2PNode:
         """
         Update the set of peers based on the provided list.
 
-        If a peer is already in the set or is this node itself, it is ignored.
+        If a peer is already in the set or is this node itself, it is ignored. The new peers
+        are added together and announced in a single broadcast of the peer list, instead of
+        exchanging peer lists with each of them, which would flood a joining network with
+        a request and a broadcast per discovered peer.
 
         Args:
             peers: A list of peers, represented as tuples of host address and port number.
         """
-        print(f"\nNew peers to update {peers}")
-        for host, port in peers:
-            if (host, port) == (self.host, self.port) or Peer(host,
-                                                              port) in self.peers:
-                continue
-            if self.connect_to_peer(host, port):
-                print(f"Discovered and connected to new peer: {host}:{port}")
-            else:
-                print(f"Could not connect to peer: {host}:{port}")
-
-    def read_next_message(self) -> str:
+        new_peers = {(host, port) for host, port in peers}
+        with self.peers_lock:
+            new_peers.difference_update(self.peers_by_address)
+            new_peers.discard((self.host, self.port))
+            if not new_peers:
+                return
+
+            for host, port in new_peers:
+                peer = Peer(host, port)
+                self.peers.add(peer)
+                self.peers_by_address[(host, port)] = peer
+            self.peers_changed()
+        self.logger.debug("Discovered new peers %s", new_peers)
+
+    def read_next_message(self) -> Optional[str]:
         """
-        Read the next message from the server.
+        Read the next message from the server, waiting until one arrives.
 
         Returns:
-            The message string.
+            The message string, or None once the node has been stopped.
         """
         return self.server.read_next_message()
 
@@ -157,20 +254,37 @@ class P2PNode:
         """
         Broadcast a message to all peers.
 
-        If sending the message to a peer fails, that peer is removed from the set of peers.
+        The message is encoded once, and the same bytes are queued for every peer. If
+        sending the message to a peer fails, that peer is removed from the set of peers.
 
         Args:
             message: The message string to broadcast.
             message_type: The type of the message. Defaults to "chat".
         """
-        print(f"\nBroadcasting to peers: {self.peers}")
-        for peer in list(
-            self.peers
-        ):  # Create a copy of the set to avoid 'set changed size during iteration' error
+        if not self.get_peers_snapshot():
+            self.logger.debug("No peers to broadcast to")
+            return
+        self.broadcast_encoded(self.client.message_protocol.encode(message_type, message))
+
+    def broadcast_encoded(self, encoded_message: bytes) -> None:
+        """
+        Broadcast an already encoded message to all peers.
+
+        If sending the message to a peer fails, that peer is removed from the set of peers.
+
+        Args:
+            encoded_message: The encoded message to broadcast, without the length prefix.
+        """
+        peers = self.get_peers_snapshot()
+        self.logger.debug("Broadcasting to peers: %s", peers)
+        if not peers:
+            return
+        header = self.client.message_protocol.frame_header(encoded_message)
+        for peer in peers:
             try:
-                self.client.send_message(peer.host, peer.port, message_type, message)
+                self.client.queue_message(peer, encoded_message, header)
             except Exception as e:
-                print(
-                    f"Failed to send message to {peer.host}:{peer.port}. Error: {str(e)}"
+                self.logger.warning(
+                    "Failed to send message to %s:%s. Error: %s", peer.host, peer.port, e
                 )
-                self.peers.remove(peer)
+                self.remove_peer(peer.host, peer.port)
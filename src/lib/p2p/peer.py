@@ -0,0 +1,34 @@
+"""
+A peer in a peer-to-peer network, identified by its host address and port number.
+"""
+
+from dataclasses import dataclass
+from typing import Tuple
+
+
+@dataclass(frozen=True)
+class Peer:
+    """
+    A class representing a peer in a peer-to-peer network.
+
+    Attributes:
+        host: The host address of the peer.
+        port: The port number of the peer.
+    """
+    # Nodes keep a Peer per known node, so instances go without a __dict__. Peers are looked
+    # up in sets and dicts constantly, so the hash is computed only once and kept in _hash.
+    __slots__ = ("host", "port", "_hash")
+
+    host: str
+    port: int
+
+    def __post_init__(self):
+        object.__setattr__(self, "_hash", hash((self.host, self.port)))
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __reduce__(self) -> Tuple[type, Tuple[str, int]]:
+        # Restoring the slots of a frozen instance through setattr fails, so copies and
+        # pickles are rebuilt through __init__, which also recomputes the cached hash
+        return type(self), (self.host, self.port)
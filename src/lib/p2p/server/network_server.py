@@ -1,29 +1,85 @@
+"""
+The low-level network server accepting connections from other nodes.
+
+The listening socket asks for the largest accept queue the system allows, so bursts of
+nodes (re)joining the network are not refused. On Linux the queue is capped by the
+net.core.somaxconn sysctl, and packets waiting for the network stack by
+net.core.netdev_max_backlog. Busy nodes may need to raise both, e.g. to 4096 and 5000.
+"""
+
+import errno
+import logging
+import selectors
 import socket
 import threading
-from typing import Callable
+import time
+from typing import Any, Callable, Dict, Optional
+
+from src.lib.p2p.utils.message_protocol import MessageProtocol
+from src.lib.p2p.utils.socket_options import configure_socket
 
 
 class NetworkServer:
     """
     NetworkServer is the low-level server that handles networking.
-    It accepts connections and then spawns a new thread to handle each connection,
-    calling a provided handler function with the client socket and the message.
+    It runs a single thread that waits for readiness events on the listening socket and on
+    every accepted connection, calling a provided handler function with the payload of every
+    complete frame received. The payload is a memoryview into the connection buffer and is
+    only valid for the duration of the call; handlers must copy what they keep.
 
     Args:
         host (str): The hostname or IP address on which the server is listening.
         port (int): The port number on which the server is listening.
-        handler (Callable): The handler function to be called when a client connection is established.
+        handler (Callable): The handler function to be called with every received message.
+        rcvbuf (Optional[int]): The receive buffer size of accepted connections, or None to let
+            the kernel autotune it.
+        sndbuf (Optional[int]): The send buffer size of accepted connections, or None to let
+            the kernel autotune it.
     """
 
-    def __init__(self, host: str, port: int, handler: Callable):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        handler: Callable,
+        rcvbuf: Optional[int] = None,
+        sndbuf: Optional[int] = None,
+    ):
+        self.logger = logging.getLogger(__name__)
         self.host = host
         self.port = port
         self.handler = handler
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.message_protocol = MessageProtocol()
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,
                                       1)
+        # Buffer sizes must be set before listen() to take effect on accepted connections
+        configure_socket(self.server_socket, rcvbuf, sndbuf)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen()
+        self.server_socket.listen(socket.SOMAXCONN)
+        self.server_socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        # Connections are registered with their stream buffer, the listening socket with None
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        # stop() writes to this pair to wake up the select() without opening a connection
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, None)
+        # Every read lands in this buffer first, there is only one thread reading
+        self.receive_view = memoryview(bytearray(65536))
+        # Reads that fill the whole buffer are repeated at most this many times per event,
+        # saving a select() round trip per 64 KiB without starving other connections
+        self.max_reads_per_event = 16
+        # Pending connections accepted per readiness event of the listening socket, so a burst of
+        # joining peers is drained in one go without starving established connections
+        self.max_accepts_per_event = 64
+        # Seconds to pause accepting while the process or system is out of file descriptors, as
+        # the listening socket stays readable and the loop would otherwise spin until one is freed
+        self.accept_retry_delay = 0.1
+        # The peer address of every connection, as returned by accept(), for logging
+        self.client_addresses: Dict[socket.socket, Any] = {}
         self.running = False
         self.thread = None
 
@@ -36,28 +92,128 @@ class NetworkServer:
     def stop(self) -> None:
         """Stops the server and clean up the resources."""
         self.running = False
-        # Create a dummy connection to unblock the accept()
-        socket.create_connection((self.host, self.port))
-        if self.thread:
-            self.thread.join(timeout=1)
+        if self.thread is None:
+            # The server never ran, so there is no loop to release the resources
+            self.close()
+            return
+        # Wake up the select(), the loop then sees that the server is no longer running
+        try:
+            self.wake_writer.send(b"\0")
+        except OSError:  # already stopped and closed
+            pass
+        self.thread.join(timeout=1)
 
     def run(self) -> None:
-        """Runs the server, continuously accepting new client connections."""
+        """Runs the server, dispatching readiness events until it is stopped."""
         while self.running:
+            for key, _ in self.selector.select():
+                # Only stop() ends the loop, an error on one socket must not stop the others
+                try:
+                    if key.fileobj is self.wake_reader:
+                        self.drain_wakeups()
+                    elif key.data is None:
+                        self.accept_client()
+                    else:
+                        self.handle_client(key.fileobj, key.data)
+                except Exception:
+                    self.logger.exception("Unexpected error in the server loop")
+        self.close_clients()
+        self.close()
+
+    def close(self) -> None:
+        """Closes the listening socket, the wake-up socket pair and the selector."""
+        self.selector.close()
+        self.server_socket.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+    def drain_wakeups(self) -> None:
+        """Discards the bytes written to wake up the server, so the next select() blocks again."""
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def accept_client(self) -> None:
+        """Accepts the pending client connections and starts watching them for incoming data."""
+        for _ in range(self.max_accepts_per_event):
             try:
                 client_socket, address = self.server_socket.accept()
-                threading.Thread(target=self.handle_client,
-                                 args=(client_socket,)).start()
-            except Exception as e:
-                pass
+            except BlockingIOError:
+                return
+            except OSError as e:  # e.g. out of file descriptors, or aborted by the client
+                self.logger.warning("Failed to accept connection: %s", e)
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    time.sleep(self.accept_retry_delay)
+                return
+            try:
+                configure_socket(client_socket, self.rcvbuf, self.sndbuf)
+                client_socket.setblocking(False)
+                self.selector.register(client_socket, selectors.EVENT_READ, bytearray())
+            except OSError as e:
+                self.logger.warning("Failed to set up connection from %s: %s", address, e)
+                client_socket.close()
+                continue
+            self.client_addresses[client_socket] = address
+            self.logger.debug("Accepted connection from %s", address)
 
-    def handle_client(self, client_socket: socket.socket) -> None:
-        """Handles a client connection.
+    def handle_client(self, client_socket: socket.socket, buffer: bytearray) -> None:
+        """Reads the available data from a client connection and handles complete frames.
 
         Args:
             client_socket (socket.socket): The client socket.
+            buffer (bytearray): The data received on the connection that is not yet handled.
         """
-        while self.running:
-            data = client_socket.recv(1024)
-            if data:
-                self.handler(data)
+        disconnected = False
+        for _ in range(self.max_reads_per_event):
+            try:
+                received = client_socket.recv_into(self.receive_view)
+            except BlockingIOError:
+                break
+            except OSError:  # e.g. reset by the peer, or timed out by keepalive probes
+                received = 0
+            if not received:
+                disconnected = True
+                break
+            buffer += self.receive_view[:received]
+            if received < len(self.receive_view):
+                break
+
+        view = memoryview(buffer)
+        frames = []
+        try:
+            frames, consumed = self.message_protocol.split_frames(view)
+            for frame in frames:
+                self.handler(frame)
+        except Exception:
+            self.logger.exception(
+                "Failed to handle message from %s, closing connection",
+                self.client_addresses.get(client_socket),
+            )
+            disconnected = True
+        finally:
+            for frame in frames:
+                frame.release()
+            view.release()
+        if disconnected:
+            self.close_client(client_socket)
+            return
+        del buffer[:consumed]
+
+    def close_client(self, client_socket: socket.socket) -> None:
+        """Stops watching a client connection and closes it.
+
+        Args:
+            client_socket (socket.socket): The client socket.
+        """
+        self.selector.unregister(client_socket)
+        address = self.client_addresses.pop(client_socket, None)
+        self.logger.debug("Closing connection from %s", address)
+        client_socket.close()
+
+    def close_clients(self) -> None:
+        """Closes all client connections."""
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self.close_client(key.fileobj)
@@ -2,8 +2,9 @@
 P2PServer is the high-level server. It uses NetworkServer to accept and handle connections, and then further processes messages as needed by your application in handle_message method.
 """
 
+import logging
 import queue
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional, Union
 
 from src.lib.p2p.server.network_server import NetworkServer
 from src.lib.p2p.utils.message_protocol import MessageProtocol
@@ -21,9 +22,21 @@ class P2PServer:
         running: A flag indicating whether this server is running.
         message_protocol: The protocol for encoding and decoding messages.
         chat_queue: A queue storing chat messages.
+        message_handlers: The handlers for the data of each message type.
+        decoded_message: The dictionary that incoming messages are decoded into and reused for.
     """
 
-    def __init__(self, node: Any, host: str, port: int):
+    # Once this many chat messages are unread, the oldest ones are dropped, None keeps them all
+    max_chat_messages: Optional[int] = 10000
+
+    def __init__(
+        self,
+        node: Any,
+        host: str,
+        port: int,
+        rcvbuf: Optional[int] = None,
+        sndbuf: Optional[int] = None,
+    ):
         """
         Initialize a new P2PServer instance.
 
@@ -31,14 +44,41 @@ class P2PServer:
             node: The node this server belongs to.
             host: The server's host address.
             port: The port that the server listens on.
+            rcvbuf: The receive buffer size of accepted connections, or None to let the kernel autotune it.
+            sndbuf: The send buffer size of accepted connections, or None to let the kernel autotune it.
         """
+        self.logger: logging.Logger = logging.getLogger(__name__)
         self.node = node
         self.host = host
         self.port = port
-        self.network_server = NetworkServer(host, port, self.handle_message)
+        self.network_server = NetworkServer(
+            host, port, self.handle_message, rcvbuf, sndbuf
+        )
         self.running: bool = False
         self.message_protocol: MessageProtocol = MessageProtocol()
-        self.chat_queue: queue.Queue = queue.Queue()  # Queue for storing chat messages
+        self.chat_queue: queue.SimpleQueue = queue.SimpleQueue()  # Queue for storing chat messages
+        self.message_handlers: Dict[str, Callable[[Any], None]] = {
+            "chat": self.handle_chat,
+            "request_peers": self.handle_request_peers,
+            "update_peers": self.handle_update_peers,
+        }
+        # Messages are handled one at a time on the network server's thread, so one will do
+        self.decoded_message: Dict[str, Any] = {}
+
+    def register_handler(self, message_type: str, handler: Callable[[Any], None]) -> None:
+        """
+        Register the handler for the data of a message type, replacing any previous one.
+
+        Messages of types without a dedicated encoding are sent as JSON, so applications can
+        add their own message types without changing the protocol. Handlers run on the network
+        server's thread and are called with the decoded data, which is copied out of the receive
+        buffer and can be kept. Only handle_message itself sees the short-lived memoryview.
+
+        Args:
+            message_type: The type of the messages to handle.
+            handler: The function called with the data of every message of that type.
+        """
+        self.message_handlers[message_type] = handler
 
     def start(self) -> None:
         """Start the server."""
@@ -46,36 +86,79 @@ class P2PServer:
         self.network_server.start()
 
     def stop(self) -> None:
-        """Stop the server."""
+        """Stop the server and wake up any reader waiting for a chat message."""
         self.running = False
         self.network_server.stop()
+        self.chat_queue.put(None)
 
-    def handle_message(self, data: bytes) -> None:
+    def handle_message(self, data: Union[bytes, memoryview]) -> None:
         """
-        Handle an incoming message.
+        Handle an incoming message by dispatching its data to the handler for its type.
+
+        The network server passes a memoryview into the connection buffer, which is only
+        valid for the duration of the call. The message is fully decoded before it is
+        dispatched, so the handlers never see the view.
 
         Args:
             data: The raw message data to handle.
         """
-        message: Dict[str, Any] = self.message_protocol.decode_message(data)
-        message_type: str = message["type"]
-        if message_type == "chat":
-            self.chat_queue.put(message["data"])  # Add chat messages to the queue
-        elif message_type == "request_peers":
-            self.node.broadcast_message(
-                self.node.get_serializable_peers(),
-                message_type="update_peers",
-            )
-        elif message_type == "update_peers":
-            self.node.update_peers(message["data"])
-        else:
-            print(f"Unknown message type: {message_type}")
+        # Decode into the reused dictionary rather than allocating one per message
+        try:
+            decoded = self.message_protocol.decode_message(data, self.decoded_message)
+            message_type: str = decoded["type"]
+            handler = self.message_handlers.get(message_type)
+            if handler is None:
+                self.logger.warning("Unknown message type: %s", message_type)
+                return
+            handler(decoded["data"])
+        finally:
+            # Drop the references to the message data until the next message arrives
+            self.decoded_message.clear()
+
+    def handle_chat(self, data: Any) -> None:
+        """
+        Handle a chat message by adding it to the chat queue.
+
+        If the queue is full, the oldest unread message is dropped to make room.
+
+        Args:
+            data: The chat message.
+        """
+        if (
+            self.max_chat_messages is not None
+            and self.chat_queue.qsize() >= self.max_chat_messages
+        ):
+            try:
+                self.chat_queue.get_nowait()
+            except queue.Empty:  # the reader took it in the meantime
+                pass
+        self.chat_queue.put(data)
+
+    def handle_request_peers(self, data: Any) -> None:
+        """
+        Handle a request for the peer list by broadcasting it to all peers.
+
+        The node caches the encoded peer list, so repeated requests do not encode it again.
+
+        Args:
+            data: The message data (unused).
+        """
+        self.node.broadcast_encoded(self.node.get_encoded_peers())
+
+    def handle_update_peers(self, data: Any) -> None:
+        """
+        Handle a peer list sent by another node.
+
+        Args:
+            data: The peers, as pairs of host address and port number.
+        """
+        self.node.update_peers(data)
 
     def read_next_message(self) -> Optional[str]:
         """
-        Read the next message from the chat queue.
+        Read the next message from the chat queue, waiting until one arrives.
 
         Returns:
-            The next message from the chat queue, if one exists.
+            The next message from the chat queue, or None once the server has been stopped.
         """
         return self.chat_queue.get()
@@ -1,33 +1,270 @@
-import json
-from typing import Dict, Any
+import struct
+from typing import Callable, Dict, Any, List, Optional, Sequence, Tuple, Union
+
+try:
+    from orjson import dumps as _dumps, loads as _loads
+except ImportError:
+    import json
+
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    def _loads(data: Union[bytes, memoryview]) -> Any:
+        # Unlike orjson, the json module does not accept memoryviews
+        return json.loads(bytes(data))
+
+# One-byte tags identifying the message type at the start of every payload
+GENERIC_TAG = 0x00
+CHAT_TAG = 0x01
+REQUEST_PEERS_TAG = 0x02
+UPDATE_PEERS_TAG = 0x03
+
+_GENERIC_PREFIX = bytes((GENERIC_TAG,))
+_CHAT_PREFIX = bytes((CHAT_TAG,))
+_UPDATE_PEERS_PREFIX = bytes((UPDATE_PEERS_TAG,))
+# A request for peers carries no data, so its payload is always the same
+_REQUEST_PEERS_PAYLOAD = bytes((REQUEST_PEERS_TAG,))
+
+# Every frame starts with the payload length as a 4-byte big-endian integer
+_HEADER = struct.Struct("!I")
+# Longer frames are refused, so a peer cannot make a node buffer gigabytes for one message.
+# This leaves room for the largest peer list, 1 + 2 + 65535 * (3 + 255) = 16908033 bytes.
+MAX_FRAME_SIZE = 1 << 25
+
+# Peer lists are a peer count followed by a port, host length and host per peer
+_PEER_COUNT = struct.Struct("!H")
+_PEER_ENTRY = struct.Struct("!HB")
+_MAX_PEERS = 0xFFFF
+_MAX_HOST_LENGTH = 0xFF
 
 
 class MessageProtocol:
     """
     This class represents the protocol for sending messages in the P2P network.
-    It provides methods to encode and decode messages using JSON.
+    It provides methods to encode and decode messages, using JSON through orjson
+    when it is installed and the standard library json module otherwise.
+
+    On the wire every message is framed with a 4-byte big-endian length prefix,
+    so messages can be streamed over a single connection. Every payload starts
+    with a one-byte type tag:
+
+    - chat: the JSON-encoded data.
+    - request_peers: nothing else.
+    - update_peers: the peer list in a compact binary encoding, see encode_peers.
+    - any other type: the JSON-encoded message dictionary.
     """
 
+    def __init__(self):
+        self.encoders: Dict[str, Callable[[Any], bytes]] = {
+            "chat": self.encode_chat,
+            "request_peers": self.encode_request_peers,
+            "update_peers": self.encode_update_peers,
+        }
+
     def encode_message(self, message: Dict[str, Any]) -> bytes:
         """
-        Encodes a message into JSON format and then encodes it to bytes.
+        Encodes a message into its tagged binary form.
 
         Args:
             message: A dictionary representing the message.
 
         Returns:
-            The encoded message as bytes.
+            The encoded message as bytes, without the length prefix.
         """
-        return json.dumps(message).encode()
+        return self.encode(message["type"], message["data"])
 
-    def decode_message(self, data: bytes) -> Dict[str, Any]:
+    def encode(self, message_type: str, data: Any) -> bytes:
         """
-        Decodes a message from bytes to JSON format and then converts it to a dictionary.
+        Encodes the type and data of a message into its tagged binary form.
+
+        Unlike encode_message, no message dictionary is needed for the known message types.
 
         Args:
-            data: The message data in bytes format.
+            message_type: The type of the message.
+            data: The data of the message.
 
         Returns:
-            The decoded message as a dictionary.
+            The encoded message as bytes, without the length prefix.
+        """
+        encoder = self.encoders.get(message_type)
+        if encoder is None:
+            return _GENERIC_PREFIX + _dumps({"type": message_type, "data": data})
+        return encoder(data)
+
+    def encode_chat(self, data: Any) -> bytes:
+        """
+        Encodes the data of a chat message.
+
+        Args:
+            data: The chat message.
+
+        Returns:
+            The encoded message as bytes, without the length prefix.
+        """
+        return _CHAT_PREFIX + _dumps(data)
+
+    def encode_request_peers(self, data: Any = None) -> bytes:
+        """
+        Encodes a request for the peer list.
+
+        Args:
+            data: The message data (unused).
+
+        Returns:
+            The encoded message as bytes, without the length prefix.
+        """
+        return _REQUEST_PEERS_PAYLOAD
+
+    def encode_update_peers(self, data: Sequence[Tuple[str, int]]) -> bytes:
+        """
+        Encodes a peer list message.
+
+        Args:
+            data: The peers, as pairs of host address and port number.
+
+        Returns:
+            The encoded message as bytes, without the length prefix.
+        """
+        return _UPDATE_PEERS_PREFIX + self.encode_peers(data)
+
+    def frame_header(self, payload: bytes) -> bytes:
+        """
+        Builds the length prefix that precedes a payload on the wire.
+
+        The header is kept separate from the payload, so both can be written with a
+        single scatter-gather call instead of being concatenated first.
+
+        Args:
+            payload: The encoded message.
+
+        Returns:
+            The length prefix as bytes.
+
+        Raises:
+            ValueError: If the payload is longer than MAX_FRAME_SIZE, which receivers refuse.
+        """
+        if len(payload) > MAX_FRAME_SIZE:
+            raise ValueError(
+                f"Message of {len(payload)} bytes exceeds {MAX_FRAME_SIZE} bytes"
+            )
+        return _HEADER.pack(len(payload))
+
+    def decode_message(
+        self, data: Union[bytes, memoryview], out: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """
+        Decodes a message from its tagged binary form into a dictionary.
+
+        Args:
+            data: The message payload, without the length prefix.
+            out: A dictionary to fill with the message instead of creating a new one, so
+                callers can reuse it across messages. Its previous contents are discarded.
+
+        Returns:
+            The decoded message as a dictionary, out if it was given. Generic messages are
+            decoded straight into a new dictionary, since the JSON parser creates one anyway.
+        """
+        tag = data[0]
+        if tag == GENERIC_TAG:
+            return _loads(data[1:])
+        if out is None:
+            out = {}
+        else:
+            out.clear()
+        if tag == CHAT_TAG:
+            out["type"] = "chat"
+            out["data"] = _loads(data[1:])
+        elif tag == REQUEST_PEERS_TAG:
+            out["type"] = "request_peers"
+            out["data"] = None
+        elif tag == UPDATE_PEERS_TAG:
+            out["type"] = "update_peers"
+            out["data"] = self.decode_peers(data, 1)
+        else:
+            raise ValueError(f"Unknown message tag: {tag:#04x}")
+        return out
+
+    def encode_peers(self, peers: Sequence[Tuple[str, int]]) -> bytes:
+        """
+        Encodes a peer list into its compact binary form.
+
+        The list starts with a 2-byte peer count, followed by a 2-byte port, a 1-byte
+        host length and the UTF-8 encoded host for every peer.
+
+        Args:
+            peers: The peers, as pairs of host address and port number.
+
+        Returns:
+            The encoded peer list as bytes.
+
+        Raises:
+            ValueError: If there are more than 65535 peers or a host is longer than 255 bytes.
+        """
+        if len(peers) > _MAX_PEERS:
+            raise ValueError(f"Cannot encode {len(peers)} peers, at most {_MAX_PEERS}")
+        parts = [_PEER_COUNT.pack(len(peers))]
+        for host, port in peers:
+            encoded_host = host.encode()
+            if len(encoded_host) > _MAX_HOST_LENGTH:
+                raise ValueError(
+                    f"Host of {len(encoded_host)} bytes exceeds {_MAX_HOST_LENGTH} bytes"
+                )
+            parts.append(_PEER_ENTRY.pack(port, len(encoded_host)))
+            parts.append(encoded_host)
+        return b"".join(parts)
+
+    def decode_peers(
+        self, data: Union[bytes, memoryview], offset: int = 0
+    ) -> List[Tuple[str, int]]:
+        """
+        Decodes a peer list from its compact binary form.
+
+        Args:
+            data: The bytes holding the encoded peer list.
+            offset: The position of the encoded peer list within data.
+
+        Returns:
+            The peers, as pairs of host address and port number.
+        """
+        (count,) = _PEER_COUNT.unpack_from(data, offset)
+        offset += _PEER_COUNT.size
+        peers = []
+        for _ in range(count):
+            port, host_length = _PEER_ENTRY.unpack_from(data, offset)
+            offset += _PEER_ENTRY.size
+            peers.append((str(data[offset:offset + host_length], "utf-8"), port))
+            offset += host_length
+        return peers
+
+    def split_frames(self, view: memoryview) -> Tuple[List[memoryview], int]:
+        """
+        Splits the complete frames off the start of a stream buffer without copying them.
+
+        The returned payloads are views into the buffer. They must be released before
+        the buffer is resized, e.g. to remove the consumed frames.
+
+        Args:
+            view: A view of the bytes received so far on a connection.
+
+        Returns:
+            The payloads of the complete frames, in the order they were received, and
+            the number of bytes they span. Incomplete trailing data is not consumed.
+
+        Raises:
+            ValueError: If a frame is longer than MAX_FRAME_SIZE.
         """
-        return json.loads(data.decode())
+        frames = []
+        offset = 0
+        header_size = _HEADER.size
+        while len(view) - offset >= header_size:
+            (length,) = _HEADER.unpack_from(view, offset)
+            if length > MAX_FRAME_SIZE:
+                for frame in frames:
+                    frame.release()
+                raise ValueError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE} bytes")
+            end = offset + header_size + length
+            if len(view) < end:
+                break
+            frames.append(view[offset + header_size:end])
+            offset = end
+        return frames, offset
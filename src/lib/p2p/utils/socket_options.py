@@ -0,0 +1,46 @@
+"""
+Socket options shared by both ends of the TCP connections between nodes.
+
+The send and receive buffer sizes are left to the kernel by default. Linux autotunes them
+per connection, growing the receive buffer up to the net.ipv4.tcp_rmem maximum (4 MiB by
+default) as the bandwidth-delay product requires. Setting SO_RCVBUF or SO_SNDBUF disables
+that autotuning for the socket and caps its window, which slows down links with a large
+bandwidth-delay product, so the sizes are only set when explicitly requested.
+"""
+
+import socket
+from typing import Optional
+
+# Probe a silent connection after 30 seconds, and give up after 3 unanswered probes 10 seconds apart
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+
+def configure_socket(
+    sock: socket.socket, rcvbuf: Optional[int] = None, sndbuf: Optional[int] = None
+) -> None:
+    """
+    Configures a socket used for a connection between nodes.
+
+    Disables Nagle's algorithm, since messages are small and latency sensitive, and enables
+    keepalive probes so that dead peers are detected even when nothing is being sent to them.
+
+    Args:
+        sock: The socket to configure.
+        rcvbuf: The receive buffer size in bytes, or None to let the kernel autotune it.
+        sndbuf: The send buffer size in bytes, or None to let the kernel autotune it.
+    """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    if sndbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The keepalive timings can only be tuned per socket on some platforms, e.g. Linux
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
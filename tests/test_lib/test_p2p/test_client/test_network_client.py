@@ -1,6 +1,7 @@
 import pytest
 import socket
 import threading
+import time
 
 from src.lib.p2p.client.network_client import NetworkClient
 
@@ -10,6 +11,7 @@ class EchoServer:
         self.host = host
         self.port = port
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(1)
         self.running = False
@@ -24,6 +26,7 @@ class EchoServer:
         self.running = False
         socket.create_connection((self.host, self.port))
         self.thread.join()
+        self.server_socket.close()
 
     def run(self):
         while self.running:
@@ -58,5 +61,66 @@ def test_network_client(server):
     message = b"Hello, Server!"
     client.send(message)
     client.close()
+    time.sleep(0.5)  # allow data to be handled by server
 
     assert server.get_last_received_message() == message
+
+
+def test_network_client_send_parts(server):
+    client = NetworkClient()
+    client.connect("localhost", 12345)
+    client.send_parts([b"Hello, ", b"", b"Server!"])
+    client.close()
+    time.sleep(0.5)  # allow data to be handled by server
+
+    assert server.get_last_received_message() == b"Hello, Server!"
+
+
+def test_network_client_disables_nagle(server):
+    client = NetworkClient()
+    client.connect("localhost", 12345)
+    try:
+        assert client.client_socket.getsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY
+        )
+        # the connect timeout does not apply to sending
+        assert client.client_socket.gettimeout() is None
+    finally:
+        client.close()
+
+
+def test_network_client_connect_failure():
+    client = NetworkClient()
+    with pytest.raises(ConnectionRefusedError):
+        client.connect("localhost", 12399)
+
+    assert client.client_socket is None
+
+
+
+def test_network_client_is_connected_with_high_file_descriptor():
+    fcntl = pytest.importorskip("fcntl")
+    resource = pytest.importorskip("resource")
+    high_fd = 1100  # beyond the FD_SETSIZE limit of select()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard <= high_fd:
+        pytest.skip("cannot open file descriptors this high")
+    if soft != resource.RLIM_INFINITY and soft <= high_fd:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (high_fd + 1, hard))
+
+    local, remote = socket.socketpair()
+    network_client = NetworkClient()
+    try:
+        network_client.client_socket = socket.socket(
+            fileno=fcntl.fcntl(local.fileno(), fcntl.F_DUPFD, high_fd)
+        )
+        assert network_client.client_socket.fileno() >= high_fd
+        assert network_client.is_connected()
+
+        remote.close()
+        assert not network_client.is_connected()
+    finally:
+        network_client.close()
+        local.close()
+        remote.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
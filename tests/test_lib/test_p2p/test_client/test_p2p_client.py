@@ -1,44 +1,102 @@
+import socket
+import time
 from unittest.mock import patch, Mock
 from src.lib.p2p.client.p2p_client import P2PClient
 from src.lib.p2p.client.network_client import NetworkClient
+from src.lib.p2p.peer import Peer
 
 
 def test_send_message():
     mock_node = Mock()
     p2p_client = P2PClient(mock_node)
 
-    with patch("threading.Thread.start"), patch.object(
-        p2p_client.message_protocol, "encode_message"
+    with patch.object(p2p_client.executor, "submit") as mock_submit, patch.object(
+        p2p_client.message_protocol, "encode"
     ) as mock_encode:
         mock_encode.return_value = b"encoded_message"
         p2p_client.send_message("localhost", 5000, "message_type", "data")
 
-        # check if message_protocol.encode_message is called correctly
-        mock_encode.assert_called_with({"type": "message_type", "data": "data"})
+        # check if message_protocol.encode is called correctly
+        mock_encode.assert_called_with("message_type", "data")
+        # check if sending is handed over to the executor
+        peer = Peer("localhost", 5000)
+        mock_submit.assert_called_with(
+            p2p_client.flush, peer, p2p_client.get_connection(peer)
+        )
 
 
-def test_connect_and_send_success():
+def test_queue_message_coalesces_pending_messages():
     mock_node = Mock()
     p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 5000)
+
+    with patch.object(p2p_client.executor, "submit") as mock_submit:
+        p2p_client.queue_message(peer, b"first")
+        p2p_client.queue_message(peer, b"second")
+
+    # a single flush is scheduled for both messages
+    mock_submit.assert_called_once_with(
+        p2p_client.flush, peer, p2p_client.get_connection(peer)
+    )
+    assert p2p_client.get_connection(peer).pending == [
+        (5).to_bytes(4, "big"),
+        b"first",
+        (6).to_bytes(4, "big"),
+        b"second",
+    ]
+
+
+def test_flush_success():
+    mock_node = Mock()
+    p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 5000)
+    p2p_client.get_connection(peer).pending.append(b"encoded_message")
 
     with patch.object(NetworkClient, "connect") as mock_connect, patch.object(
-        NetworkClient, "send"
+        NetworkClient, "send_parts"
     ) as mock_send, patch.object(NetworkClient, "close") as mock_close:
         mock_connect.return_value = None
         mock_send.return_value = None
         mock_close.return_value = None
 
-        p2p_client.connect_and_send("localhost", 5000, b"encoded_message")
+        p2p_client.flush(peer)
 
     # check if network client's methods were called correctly
     mock_connect.assert_called_with("localhost", 5000)
-    mock_send.assert_called_with(b"encoded_message")
-    mock_close.assert_called()
+    mock_send.assert_called_with([b"encoded_message"])
+    # the connection is kept open for the next message
+    mock_close.assert_not_called()
+    assert p2p_client.get_connection(peer).pending == []
 
 
-def test_connect_and_send_failure():
+def test_flush_reuses_connection():
     mock_node = Mock()
     p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 5000)
+
+    def fake_connect(network_client, host, port):
+        network_client.client_socket = Mock()
+        network_client.client_socket.sendmsg.side_effect = lambda buffers: sum(
+            buffer.nbytes for buffer in buffers
+        )
+
+    with patch.object(
+        NetworkClient, "connect", autospec=True, side_effect=fake_connect
+    ) as mock_connect, patch.object(NetworkClient, "is_connected", return_value=True):
+        for message in (b"first", b"second"):
+            p2p_client.get_connection(peer).pending.append(message)
+            p2p_client.flush(peer)
+
+    mock_connect.assert_called_once()
+    network_client = p2p_client.get_connection(peer).network_client
+    assert network_client.client_socket.sendmsg.call_count == 2
+
+
+def test_flush_failure():
+    mock_node = Mock()
+    p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 5000)
+    p2p_client.get_connection(peer).pending.append(b"encoded_message")
 
     with patch.object(NetworkClient, "connect") as mock_connect, patch.object(
         NetworkClient, "close"
@@ -46,7 +104,118 @@ def test_connect_and_send_failure():
         mock_connect.side_effect = ConnectionRefusedError
         mock_close.return_value = None
 
-        p2p_client.connect_and_send("localhost", 5000, b"encoded_message")
+        p2p_client.flush(peer)
 
     # check if node.remove_peer was called when a connection failure occurs
     mock_remove_peer.assert_called_with("localhost", 5000)
+    assert peer not in p2p_client.connections
+
+
+def test_flush_drains_connection_dropped_after_queueing():
+    mock_node = Mock()
+    p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 5000)
+
+    with patch.object(p2p_client.executor, "submit") as mock_submit:
+        p2p_client.queue_message(peer, b"encoded_message")
+    # a failed flush drops the connection before the scheduled flush runs
+    p2p_client.drop_connection(peer)
+
+    with patch.object(NetworkClient, "connect"), patch.object(
+        NetworkClient, "send_parts"
+    ) as mock_send, patch.object(NetworkClient, "close") as mock_close:
+        mock_submit.call_args.args[0](*mock_submit.call_args.args[1:])
+
+    mock_send.assert_called_once_with(
+        [(15).to_bytes(4, "big"), b"encoded_message"]
+    )
+    # the dropped connection is not kept open after its messages were sent
+    mock_close.assert_called_once()
+
+
+def test_flush_failure_keeps_newer_connection():
+    mock_node = Mock()
+    p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 5000)
+    old_connection = p2p_client.get_connection(peer)
+    old_connection.pending.append(b"encoded_message")
+    p2p_client.drop_connection(peer)
+    new_connection = p2p_client.get_connection(peer)
+
+    with patch.object(NetworkClient, "connect") as mock_connect:
+        mock_connect.side_effect = ConnectionRefusedError
+        p2p_client.flush(peer, old_connection)
+
+    assert p2p_client.connections[peer] is new_connection
+
+
+def test_flush_reconnects_when_write_on_open_connection_fails():
+    mock_node = Mock()
+    p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 5000)
+    connection = p2p_client.get_connection(peer)
+    broken_socket = Mock()
+    broken_socket.sendmsg.side_effect = BrokenPipeError
+    connection.network_client.client_socket = broken_socket
+    connection.pending.append(b"encoded_message")
+
+    with patch.object(NetworkClient, "is_connected", return_value=True), patch.object(
+        NetworkClient, "connect"
+    ) as mock_connect, patch.object(NetworkClient, "send_parts") as mock_send:
+        mock_send.side_effect = [BrokenPipeError, None]
+        p2p_client.flush(peer)
+
+    broken_socket.close.assert_called_once()
+    mock_connect.assert_called_once_with("localhost", 5000)
+    # the messages are sent again on the fresh connection, and the peer is kept
+    assert mock_send.call_count == 2
+    mock_node.remove_peer.assert_not_called()
+
+
+def listen(port):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(("localhost", port))
+    server_socket.listen()
+    server_socket.settimeout(1)
+    return server_socket
+
+
+def receive(server_socket, size):
+    connection, _ = server_socket.accept()
+    connection.settimeout(1)
+    data = b""
+    while len(data) < size:
+        data += connection.recv(size - len(data))
+    return connection, data
+
+
+def test_flush_reconnects_to_restarted_peer():
+    mock_node = Mock()
+    p2p_client = P2PClient(mock_node)
+    peer = Peer("localhost", 12350)
+
+    server_socket = listen(peer.port)
+    p2p_client.get_connection(peer).pending.append(b"first")
+    p2p_client.flush(peer)
+    connection, data = receive(server_socket, 5)
+    assert data == b"first"
+
+    # the peer restarts on the same port
+    connection.close()
+    server_socket.close()
+    server_socket = listen(peer.port)
+    time.sleep(0.1)  # allow the close to reach the client
+
+    try:
+        for message in (b"second", b"third"):
+            p2p_client.get_connection(peer).pending.append(message)
+            p2p_client.flush(peer)
+        connection, data = receive(server_socket, 11)
+        connection.close()
+    finally:
+        server_socket.close()
+        p2p_client.stop()
+
+    assert data == b"secondthird"
+    mock_node.remove_peer.assert_not_called()
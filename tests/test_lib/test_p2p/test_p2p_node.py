@@ -14,52 +14,163 @@ def p2p_node():
     return P2PNode("localhost", 5000)
 
 
+def wait_for_peers_broadcast(p2p_node):
+    timer = p2p_node.peers_broadcast_timer
+    if timer is not None:
+        timer.join()
+
+
 def test_add_peer(p2p_node, mock_peer):
-    with patch.object(p2p_node, "broadcast_message") as mock_broadcast:
+    with patch.object(p2p_node, "broadcast_encoded") as mock_broadcast:
         p2p_node.add_peer(mock_peer)
+        wait_for_peers_broadcast(p2p_node)
 
     assert mock_peer in p2p_node.peers
-    mock_broadcast.assert_called_with(
-        p2p_node.get_serializable_peers(), message_type="update_peers"
-    )
+    mock_broadcast.assert_called_with(p2p_node.get_encoded_peers())
 
 
 def test_remove_peer(p2p_node, mock_peer):
-    p2p_node.peers.add(mock_peer)
-    with patch.object(p2p_node, "broadcast_message") as mock_broadcast:
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        p2p_node.add_peer(mock_peer)
+    with patch.object(p2p_node, "broadcast_encoded") as mock_broadcast:
         p2p_node.remove_peer("localhost", 5001)
+        wait_for_peers_broadcast(p2p_node)
 
     assert mock_peer not in p2p_node.peers
-    mock_broadcast.assert_called_with(
-        p2p_node.get_serializable_peers(), message_type="update_peers"
-    )
+    mock_broadcast.assert_called_with(p2p_node.get_encoded_peers())
+
+
+def test_peer_changes_are_broadcast_once(p2p_node):
+    with patch.object(p2p_node, "broadcast_encoded") as mock_broadcast:
+        p2p_node.add_peer(Peer("localhost", 5003))
+        p2p_node.add_peer(Peer("localhost", 5004))
+        p2p_node.remove_peer("localhost", 5003)
+        wait_for_peers_broadcast(p2p_node)
+
+    mock_broadcast.assert_called_once_with(p2p_node.get_encoded_peers())
+    with patch.object(p2p_node, "broadcast_encoded"):
+        p2p_node.remove_peer("localhost", 5004)
+        wait_for_peers_broadcast(p2p_node)
 
 
 def test_connect_to_peer(p2p_node, mock_peer):
-    with patch.object(p2p_node.client, "send_message") as mock_send:
+    with patch.object(p2p_node.client, "send_message") as mock_send, patch.object(
+        p2p_node.client, "queue_message"
+    ):
         p2p_node.connect_to_peer("localhost", 5001)
+        wait_for_peers_broadcast(p2p_node)
 
     assert mock_peer in p2p_node.peers
     mock_send.assert_called()
 
 
 def test_get_serializable_peers(p2p_node, mock_peer):
-    p2p_node.peers.add(mock_peer)
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        p2p_node.add_peer(mock_peer)
     serialized_peers = p2p_node.get_serializable_peers()
     assert set(serialized_peers) == set([("localhost", 5000), ("localhost", 5001)])
 
 
+def test_get_serializable_peers_is_cached(p2p_node, mock_peer):
+    serialized_peers = p2p_node.get_serializable_peers()
+    assert p2p_node.get_serializable_peers() is serialized_peers
+
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        p2p_node.add_peer(Peer("localhost", 5003))
+        assert ("localhost", 5003) in p2p_node.get_serializable_peers()
+        p2p_node.remove_peer("localhost", 5003)
+        assert ("localhost", 5003) not in p2p_node.get_serializable_peers()
+
+
 def test_update_peers(p2p_node, mock_peer):
-    with patch.object(p2p_node.client, "send_message") as mock_send:
+    with patch.object(p2p_node.client, "queue_message"):
         p2p_node.update_peers([("localhost", 5002)])
+        wait_for_peers_broadcast(p2p_node)
 
     assert ("localhost", 5002) in p2p_node.get_serializable_peers()
 
 
+def test_update_peers_ignores_known_peers(p2p_node, mock_peer):
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        p2p_node.add_peer(mock_peer)
+    peers = set(p2p_node.peers)
+
+    with patch.object(p2p_node, "schedule_peers_broadcast") as mock_schedule:
+        # this node itself and an already known peer
+        p2p_node.update_peers([["localhost", 5000], ["localhost", 5001]])
+
+    mock_schedule.assert_not_called()
+    assert p2p_node.peers == peers
+
+
+def test_update_peers_announces_new_peers_once(p2p_node):
+    with patch.object(
+        p2p_node, "schedule_peers_broadcast"
+    ) as mock_schedule, patch.object(p2p_node.client, "queue_message") as mock_queue:
+        p2p_node.update_peers([("localhost", 5003), ("localhost", 5004)])
+        mock_schedule.assert_called_once()
+        # the new peers learn the peer list from the broadcast, not from a direct exchange
+        mock_queue.assert_not_called()
+        assert {Peer("localhost", 5003), Peer("localhost", 5004)} <= p2p_node.peers
+
+        p2p_node.remove_peer("localhost", 5003)
+        p2p_node.remove_peer("localhost", 5004)
+
+
 def test_broadcast_message(p2p_node, mock_peer):
-    p2p_node.peers.clear()
-    p2p_node.peers.add(mock_peer)
-    with patch.object(p2p_node.client, "send_message") as mock_send:
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        for peer in p2p_node.get_peers_snapshot():
+            p2p_node.remove_peer(peer.host, peer.port)
+        p2p_node.add_peer(mock_peer)
+    with patch.object(p2p_node.client, "queue_message") as mock_queue:
         p2p_node.broadcast_message("Hello!")
 
-    mock_send.assert_called_with(mock_peer.host, mock_peer.port, "chat", "Hello!")
+    encoded_message = p2p_node.client.message_protocol.encode("chat", "Hello!")
+    mock_queue.assert_called_once_with(
+        mock_peer, encoded_message, len(encoded_message).to_bytes(4, "big")
+    )
+
+
+def test_broadcast_message_encodes_once(p2p_node):
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        p2p_node.add_peer(Peer("localhost", 5003))
+        p2p_node.add_peer(Peer("localhost", 5004))
+        with patch.object(p2p_node.client, "queue_message") as mock_queue:
+            p2p_node.broadcast_message("Hello!")
+        p2p_node.remove_peer("localhost", 5003)
+        p2p_node.remove_peer("localhost", 5004)
+
+    queued = [call.args for call in mock_queue.call_args_list]
+    assert {Peer("localhost", 5003), Peer("localhost", 5004)} <= {
+        peer for peer, _, _ in queued
+    }
+    # every peer is handed the very same bytes
+    assert len({id(encoded_message) for _, encoded_message, _ in queued}) == 1
+
+
+def test_get_encoded_peers_is_cached(p2p_node):
+    encoded_peers = p2p_node.get_encoded_peers()
+    assert p2p_node.get_encoded_peers() is encoded_peers
+    assert p2p_node.client.message_protocol.decode_message(encoded_peers) == {
+        "type": "update_peers",
+        "data": list(p2p_node.get_serializable_peers()),
+    }
+
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        p2p_node.add_peer(Peer("localhost", 5003))
+        assert p2p_node.get_encoded_peers() != encoded_peers
+        p2p_node.remove_peer("localhost", 5003)
+
+
+def test_peers_snapshot_is_cached(p2p_node, mock_peer):
+    peers_snapshot = p2p_node.get_peers_snapshot()
+    assert p2p_node.get_peers_snapshot() is peers_snapshot
+    assert set(peers_snapshot) == p2p_node.peers
+
+    with patch.object(p2p_node, "schedule_peers_broadcast"):
+        p2p_node.add_peer(Peer("localhost", 5003))
+        assert Peer("localhost", 5003) in p2p_node.get_peers_snapshot()
+        p2p_node.remove_peer("localhost", 5003)
+        assert Peer("localhost", 5003) not in p2p_node.get_peers_snapshot()
+    # iterating a snapshot is unaffected by later changes
+    assert Peer("localhost", 5003) not in peers_snapshot
@@ -0,0 +1,35 @@
+import copy
+import pickle
+
+from src.lib.p2p.peer import Peer
+
+
+def test_peer_equality_and_hash():
+    peer = Peer("localhost", 5000)
+
+    assert peer == Peer("localhost", 5000)
+    assert peer != Peer("localhost", 5001)
+    assert hash(peer) == hash(Peer("localhost", 5000))
+    assert peer in {Peer("localhost", 5000)}
+
+
+def test_peer_repr():
+    assert repr(Peer("localhost", 5000)) == "Peer(host='localhost', port=5000)"
+
+
+def test_peer_has_no_instance_dict():
+    peer = Peer("localhost", 5000)
+
+    assert not hasattr(peer, "__dict__")
+
+
+def test_peer_copy_and_pickle():
+    peer = Peer("localhost", 5000)
+
+    for clone in (
+        copy.copy(peer),
+        copy.deepcopy(peer),
+        pickle.loads(pickle.dumps(peer)),
+    ):
+        assert clone == peer
+        assert hash(clone) == hash(peer)
@@ -1,6 +1,9 @@
+import errno
 import pytest
 import socket
+import threading
 import time
+from unittest.mock import Mock, patch
 
 from src.lib.p2p.server.network_server import NetworkServer
 
@@ -36,17 +39,175 @@ def test_server_handle_connections(server):
 
     def test_handler(data):
         nonlocal received_data
-        received_data = data
+        received_data = bytes(data)
 
     server.handler = test_handler
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
         client_socket.connect(("localhost", 12345))
-        client_socket.sendall(b"Hello, Server!")
+        message = b"Hello, Server!"
+        client_socket.sendall(len(message).to_bytes(4, "big") + message)
         time.sleep(0.5)  # allow data to be handled by server
         assert received_data == b"Hello, Server!"
     except Exception as e:
         pytest.fail(f"Should not have raised any exception, but got {e}")
     finally:
         client_socket.close()
+
+
+def test_server_handles_split_and_coalesced_frames(server):
+    received_data = []
+
+    def test_handler(data):
+        received_data.append(bytes(data))
+
+    server.handler = test_handler
+
+    frames = b"".join(
+        len(message).to_bytes(4, "big") + message
+        for message in (b"first", b"second", b"third")
+    )
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(("localhost", 12345))
+        client_socket.sendall(frames[:7])
+        time.sleep(0.1)
+        client_socket.sendall(frames[7:])
+        time.sleep(0.5)  # allow data to be handled by server
+        assert received_data == [b"first", b"second", b"third"]
+    finally:
+        client_socket.close()
+
+
+def test_server_handles_connections_on_one_thread(server):
+    received_data = []
+
+    def test_handler(data):
+        received_data.append(bytes(data))
+
+    server.handler = test_handler
+
+    thread_count = threading.active_count()
+    client_sockets = [socket.create_connection(("localhost", 12345)) for _ in range(5)]
+    try:
+        for index, client_socket in enumerate(client_sockets):
+            message = f"client {index}".encode()
+            client_socket.sendall(len(message).to_bytes(4, "big") + message)
+        time.sleep(0.5)  # allow data to be handled by server
+        assert sorted(received_data) == [f"client {index}".encode() for index in range(5)]
+        assert threading.active_count() == thread_count
+    finally:
+        for client_socket in client_sockets:
+            client_socket.close()
+
+
+def test_server_disables_nagle_on_accepted_connections(server):
+    client_socket = socket.create_connection(("localhost", 12345))
+    try:
+        time.sleep(0.5)  # allow the connection to be accepted
+        accepted_sockets = [
+            key.fileobj
+            for key in server.selector.get_map().values()
+            if key.data is not None
+        ]
+        assert accepted_sockets
+        for accepted_socket in accepted_sockets:
+            assert accepted_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    finally:
+        client_socket.close()
+
+
+def test_server_logs_client_address_when_handler_fails(server, caplog):
+    def failing_handler(data):
+        raise ValueError("bad message")
+
+    server.handler = failing_handler
+
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(("localhost", 12345))
+        client_socket.sendall((1).to_bytes(4, "big") + b"x")
+        time.sleep(0.5)  # allow data to be handled by server
+        assert str(client_socket.getsockname()) in caplog.text
+        # the failing connection is closed and forgotten
+        assert client_socket.getsockname() not in server.client_addresses.values()
+    finally:
+        client_socket.close()
+
+
+def test_server_stops_without_connecting_to_itself():
+    server = NetworkServer("localhost", 12348, echo_handler)
+    server.start()
+    with patch.object(server, "accept_client") as mock_accept:
+        server.stop()
+
+    assert not server.thread.is_alive()
+    mock_accept.assert_not_called()
+
+
+def test_server_closes_connection_announcing_oversized_frame(server):
+    received_data = []
+    server.handler = lambda data: received_data.append(bytes(data))
+
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(("localhost", 12345))
+        client_socket.sendall(b"\xff\xff\xff\xff" + b"x" * 1024)
+        client_socket.settimeout(1)
+        # the server closes the connection instead of waiting for 4 GiB
+        try:
+            assert client_socket.recv(1) == b""
+        except ConnectionResetError:  # closed before reading everything that was sent
+            pass
+        assert not received_data
+    finally:
+        client_socket.close()
+
+
+def test_server_survives_accept_failure():
+    received_data = []
+    server = NetworkServer(
+        "localhost", 12351, lambda data: received_data.append(bytes(data))
+    )
+    listening_socket = server.server_socket
+    accept_errors = [OSError(errno.EMFILE, "Too many open files")]
+
+    def accept():
+        if accept_errors:
+            raise accept_errors.pop()
+        return listening_socket.accept()
+
+    server.server_socket = Mock(wraps=listening_socket)
+    server.server_socket.accept.side_effect = accept
+    server.start()
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(("localhost", 12351))
+        message = b"Hello, Server!"
+        client_socket.sendall(len(message).to_bytes(4, "big") + message)
+        time.sleep(0.5)  # allow the accept to be retried and the data to be handled
+
+        assert not accept_errors
+        assert server.thread.is_alive()
+        assert received_data == [message]
+    finally:
+        client_socket.close()
+        server.stop()
+
+
+def test_server_releases_port_and_sockets_on_stop():
+    server = NetworkServer("localhost", 12352, echo_handler)
+    server.start()
+    server.stop()
+
+    assert not server.thread.is_alive()
+    for sock in (server.server_socket, server.wake_reader, server.wake_writer):
+        assert sock.fileno() == -1
+    # stopping again does nothing
+    server.stop()
+
+    # a new server can listen on the same port right away
+    restarted_server = NetworkServer("localhost", 12352, echo_handler)
+    restarted_server.stop()
+    assert restarted_server.server_socket.fileno() == -1
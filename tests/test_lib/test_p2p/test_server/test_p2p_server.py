@@ -1,3 +1,4 @@
+import logging
 from unittest import mock
 
 import pytest
@@ -15,9 +16,9 @@ def mock_node():
 @pytest.fixture(scope="module")
 def p2p_server(mock_node):
     """Creates a P2PServer instance with a mock node."""
-    server = P2PServer(mock_node, "localhost", 12345)
+    server = P2PServer(mock_node, "localhost", 12346)
     server.network_server = mock.MagicMock(spec=NetworkServer)
-    server.message_protocol.decode_message = lambda x: {
+    server.message_protocol.decode_message = lambda x, out=None: {
         "type": "chat",
         "data": "Hello, peer!",
     }
@@ -35,6 +36,8 @@ def test_stop(p2p_server):
     p2p_server.stop()
     assert not p2p_server.running
     p2p_server.network_server.stop.assert_called_once()
+    # stopping wakes up readers blocked on the chat queue
+    assert p2p_server.read_next_message() is None
 
 
 def test_handle_message_chat(p2p_server):
@@ -45,14 +48,16 @@ def test_handle_message_chat(p2p_server):
 
 def test_handle_message_request_peers(p2p_server, mock_node):
     message = {"type": "request_peers", "data": None}
-    p2p_server.message_protocol.decode_message = lambda x: message
+    p2p_server.message_protocol.decode_message = lambda x, out=None: message
     p2p_server.handle_message(b"Request peers.")
-    mock_node.broadcast_message.assert_called_once()
+    mock_node.broadcast_encoded.assert_called_once_with(
+        mock_node.get_encoded_peers.return_value
+    )
 
 
 def test_handle_message_update_peers(p2p_server, mock_node):
     message = {"type": "update_peers", "data": ["Peer1", "Peer2"]}
-    p2p_server.message_protocol.decode_message = lambda x: message
+    p2p_server.message_protocol.decode_message = lambda x, out=None: message
     p2p_server.handle_message(b"Update peers.")
     mock_node.update_peers.assert_called_once_with(["Peer1", "Peer2"])
 
@@ -60,3 +65,56 @@ def test_handle_message_update_peers(p2p_server, mock_node):
 def test_read_next_message(p2p_server):
     p2p_server.chat_queue.put("Hello, peer!")
     assert p2p_server.read_next_message() == "Hello, peer!"
+
+
+def test_handle_message_unknown_type(p2p_server, mock_node, caplog):
+    message = {"type": "unknown", "data": None}
+    p2p_server.message_protocol.decode_message = lambda x, out=None: message
+    mock_node.reset_mock()
+    with caplog.at_level(logging.WARNING):
+        p2p_server.handle_message(b"Unknown.")
+    assert not mock_node.method_calls
+    assert p2p_server.chat_queue.empty()
+    assert "Unknown message type: unknown" in caplog.text
+
+
+def test_handle_message_reuses_decoded_message():
+    server = P2PServer(mock.MagicMock(), "localhost", 12347)
+    server.network_server.stop()
+    decoded_message = server.decoded_message
+
+    with mock.patch.object(
+        server.message_protocol,
+        "decode_message",
+        wraps=server.message_protocol.decode_message,
+    ) as mock_decode:
+        server.handle_message(server.message_protocol.encode("chat", "first"))
+        server.handle_message(server.message_protocol.encode("chat", "second"))
+
+    assert server.chat_queue.get() == "first"
+    assert server.chat_queue.get() == "second"
+    # every message is decoded into the same dictionary, which is emptied afterwards
+    assert all(call.args[1] is decoded_message for call in mock_decode.call_args_list)
+    assert server.decoded_message is decoded_message
+    assert not decoded_message
+
+
+def test_handle_chat_drops_oldest_message_when_full(p2p_server):
+    with mock.patch.object(p2p_server, "max_chat_messages", 2):
+        for message in ("first", "second", "third"):
+            p2p_server.handle_chat(message)
+
+    assert p2p_server.chat_queue.get() == "second"
+    assert p2p_server.chat_queue.get() == "third"
+    assert p2p_server.chat_queue.empty()
+
+
+def test_register_handler():
+    server = P2PServer(mock.MagicMock(), "localhost", 12349)
+    server.network_server.stop()
+    handler = mock.Mock()
+
+    server.register_handler("ping", handler)
+    server.handle_message(server.message_protocol.encode("ping", {"seq": 1}))
+
+    handler.assert_called_once_with({"seq": 1})
@@ -0,0 +1,125 @@
+import pytest
+
+from src.lib.p2p.utils.message_protocol import MAX_FRAME_SIZE, MessageProtocol
+
+
+def frame(protocol, message):
+    payload = protocol.encode_message(message)
+    return protocol.frame_header(payload) + payload
+
+
+def test_frame_header_is_payload_length():
+    protocol = MessageProtocol()
+    payload = protocol.encode_message({"type": "chat", "data": "Hello!"})
+
+    assert int.from_bytes(protocol.frame_header(payload), "big") == len(payload)
+    assert protocol.decode_message(payload) == {"type": "chat", "data": "Hello!"}
+
+
+def test_split_frames_returns_complete_frames():
+    protocol = MessageProtocol()
+    first = frame(protocol, {"type": "chat", "data": "first"})
+    second = frame(protocol, {"type": "chat", "data": "second"})
+    buffer = bytearray(first + second)
+
+    frames, consumed = protocol.split_frames(memoryview(buffer))
+
+    assert [protocol.decode_message(frame)["data"] for frame in frames] == [
+        "first",
+        "second",
+    ]
+    assert consumed == len(buffer)
+
+
+def test_split_frames_keeps_incomplete_frame():
+    protocol = MessageProtocol()
+    complete = frame(protocol, {"type": "chat", "data": "first"})
+    incomplete = frame(protocol, {"type": "chat", "data": "second"})[:-3]
+    buffer = bytearray(complete + incomplete)
+
+    frames, consumed = protocol.split_frames(memoryview(buffer))
+
+    assert len(frames) == 1
+    assert protocol.decode_message(frames[0]) == {"type": "chat", "data": "first"}
+    assert consumed == len(complete)
+
+
+def test_encode_and_decode_message_types():
+    protocol = MessageProtocol()
+    messages = [
+        {"type": "chat", "data": "Hello!"},
+        {"type": "request_peers", "data": None},
+        {"type": "update_peers", "data": [("localhost", 5000), ("10.0.0.1", 5001)]},
+        {"type": "custom", "data": {"key": [1, 2]}},
+    ]
+
+    for message in messages:
+        assert protocol.decode_message(protocol.encode_message(message)) == message
+        assert protocol.encode(message["type"], message["data"]) == protocol.encode_message(
+            message
+        )
+
+
+def test_update_peers_is_binary_encoded():
+    protocol = MessageProtocol()
+    peers = [("localhost", 5000), ("10.0.0.1", 5001)]
+
+    encoded = protocol.encode_message({"type": "update_peers", "data": peers})
+
+    # tag, peer count, and port, host length and host for every peer
+    assert len(encoded) == 1 + 2 + sum(3 + len(host) for host, _ in peers)
+    assert protocol.decode_peers(protocol.encode_peers(peers)) == peers
+
+
+def test_decode_message_into_existing_dict():
+    protocol = MessageProtocol()
+    out = {"stale": True}
+
+    decoded = protocol.decode_message(protocol.encode("chat", "Hello!"), out)
+
+    assert decoded is out
+    assert out == {"type": "chat", "data": "Hello!"}
+
+
+def test_split_frames_rejects_oversized_frame():
+    protocol = MessageProtocol()
+    data = (MAX_FRAME_SIZE + 1).to_bytes(4, "big") + b"x"
+
+    with pytest.raises(ValueError):
+        protocol.split_frames(memoryview(data))
+
+
+def test_decode_generic_message_leaves_out_dict_alone():
+    protocol = MessageProtocol()
+    out = {}
+
+    decoded = protocol.decode_message(protocol.encode("custom", [1, 2]), out)
+
+    assert decoded == {"type": "custom", "data": [1, 2]}
+    assert decoded is not out
+
+
+def test_largest_peer_list_fits_in_a_frame():
+    protocol = MessageProtocol()
+    peers = [("h" * 255, port) for port in range(65535)]
+
+    payload = protocol.encode("update_peers", peers)
+
+    assert len(payload) <= MAX_FRAME_SIZE
+    protocol.frame_header(payload)
+
+
+def test_encode_peers_rejects_lists_the_format_cannot_hold():
+    protocol = MessageProtocol()
+
+    with pytest.raises(ValueError):
+        protocol.encode_peers([("localhost", port) for port in range(65536)])
+    with pytest.raises(ValueError):
+        protocol.encode_peers([("h" * 256, 5000)])
+
+
+def test_frame_header_rejects_oversized_payload():
+    protocol = MessageProtocol()
+
+    with pytest.raises(ValueError):
+        protocol.frame_header(b"x" * (MAX_FRAME_SIZE + 1))
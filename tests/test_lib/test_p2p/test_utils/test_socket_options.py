@@ -0,0 +1,48 @@
+import socket
+
+from src.lib.p2p.utils.socket_options import KEEPALIVE_IDLE, configure_socket
+
+
+def test_configure_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        configure_socket(sock)
+
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            assert (
+                sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE)
+                == KEEPALIVE_IDLE
+            )
+    finally:
+        sock.close()
+
+
+def test_configure_socket_keeps_default_buffer_sizes():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        sndbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        configure_socket(sock)
+
+        # the kernel keeps autotuning the buffers
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) == rcvbuf
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) == sndbuf
+    finally:
+        sock.close()
+
+
+def test_configure_socket_sets_requested_buffer_sizes():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # larger than the defaults, so both buffers change size
+        rcvbuf = 2 * sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        sndbuf = 2 * sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        configure_socket(sock, rcvbuf=rcvbuf, sndbuf=sndbuf)
+
+        # Linux doubles the requested size to account for bookkeeping overhead
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= rcvbuf
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= sndbuf
+    finally:
+        sock.close()